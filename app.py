@@ -1,144 +1,591 @@
+import io
 import os
+import time
+import queue
+import hashlib
 import logging
+import tempfile
+import threading
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import chromadb
+from chromadb.api.client import SharedSystemClient
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
+import orjson
 from google.cloud import storage
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
+from google.api_core import exceptions, retry
 import fitz
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Configure Logging
 logging.basicConfig(
-    level=logging.DEBUG,  # Set to logging.INFO in production
+    level=logging.DEBUG if os.getenv("DEBUG", "").lower() in ("1", "true", "yes") else logging.INFO,
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
 logger = logging.getLogger(__name__)
 
 # Constants
 PROJECT_ID = "ltim-delab-app"
-REGION_ID = "us-east1"
-BUCKET_NAME = "ai-app-gcs"
-FILE_NAME = "sample_cast_report.pdf"
+# The app, BUCKET_NAME and ChromaDB should share one region to avoid cross-region RTTs and egress
+REGION_ID = os.getenv("REGION_ID", "us-east1")
+BUCKET_NAME = os.getenv("BUCKET_NAME", "ai-app-gcs")
+FILE_NAME = "sample_cast_report.pdf"  # default when the request doesn't name a file
 MODEL_NAME = "gemini-pro"
 EMBEDDING_MODEL_NAME = "models/embedding-001"
-CHROMA_DB_URL = "https://chromadb-891176152394.us-central1.run.app"
+CHROMA_DB_URL = os.getenv("CHROMA_DB_URL", "https://chromadb-891176152394.us-central1.run.app")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+PAGE_BATCH_SIZE = 50  # pages of text per embedded chunk
+EMBED_BATCH_SIZE = 20  # chunks per embed_content request
+SUMMARY_WINDOW_CHARS = 8000  # characters of text per map-step summary prompt
+SUMMARY_FAN_IN = 8  # partial summaries combined per reduce-step prompt
+CACHE_MAX_ENTRIES = 256
+EMBEDDING_CACHE_MAX_ENTRIES = 10_000  # ~3 KB per cached float32 vector
+# Process-wide concurrent Gemini summary calls; also the most window texts one report queues
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "32"))
+CHROMA_WRITE_RETRIES = 5  # attempts per queued write, with exponential backoff
+CHROMA_WRITE_QUEUE_SIZE = 100  # pending writes before new ones are dropped
+CHROMA_DRAIN_TIMEOUT = 8  # seconds to flush queued writes on shutdown (Cloud Run allows 10)
+CONTENT_PREVIEW_CHARS = 500  # chunk text stored in ChromaDB metadata
+# Text-only block extraction: don't decode images on graphics-heavy pages
+TEXT_BLOCK_FLAGS = fitz.TEXTFLAGS_BLOCKS & ~fitz.TEXT_PRESERVE_IMAGES
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.05"))  # cosine distance
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", "3600"))  # seconds
+# Backoff for transient Gemini errors (quota, overload) on each summary call
+GEMINI_RETRY = retry.Retry(
+    predicate=retry.if_exception_type(
+        exceptions.ResourceExhausted,
+        exceptions.ServiceUnavailable,
+        exceptions.InternalServerError,
+        exceptions.DeadlineExceeded,
+    ),
+    initial=1.0,
+    maximum=30.0,
+    multiplier=2.0,
+    timeout=120.0,
+)
+# Fixed prompt preambles, built once and sent as the leading Part of every request
+SUMMARY_PREAMBLE = glm.Part(text="Summarize this text:")
+COMBINE_PREAMBLE = glm.Part(text="Combine these summaries into one summary:")
 
 
 # Initialize Clients
 storage_client = storage.Client()
 genai.configure(api_key=GOOGLE_API_KEY)
+GEMINI_MODEL = genai.GenerativeModel(MODEL_NAME)
+
+# Pooled keep-alive session for outbound HTTP (metadata server). No transport retries:
+# the token fetch runs under a lock, so a retry would multiply IAM_TOKEN_TIMEOUT
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=Retry(total=0))
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+
+# Pool for per-window Gemini summaries, shared by all request threads
+summary_executor = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS)
 
 # Fetch IAM Token
-try:
-    IAM_TOKEN = requests.get(
-        "http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/identity?audience=https://chromadb-891176152394.us-central1.run.app",
-        headers={"Metadata-Flavor": "Google"},
-    ).text.strip()
-    logger.info(f"IAM Token Fetched: {IAM_TOKEN[:20]}...")
-except Exception as e:
-    logger.error(f"Error fetching IAM token: {e}")
-    IAM_TOKEN = None
-
-# Test API call to ChromaDB heartbeat
-headers = {"Authorization": f"Bearer {IAM_TOKEN}"}
-try:
-    response = requests.get(f"{CHROMA_DB_URL}/api/v1/heartbeat", headers=headers)
-    logger.info(f"🔍 ChromaDB Heartbeat Status: {response.status_code}, Response: {response.text}")
-except Exception as e:
-    logger.error(f"Error checking ChromaDB heartbeat: {e}")
-
-# Initialize ChromaDB Client
-try:
-    chroma_client = chromadb.HttpClient(CHROMA_DB_URL, headers=headers)
-    logger.info("ChromaDB client initialized successfully.")
-except Exception as e:
-    logger.error(f"Error initializing ChromaDB client: {e}")
-
-# Create or get collection
-try:
-    collection = chroma_client.get_or_create_collection("cast_highlight_reports")
-    logger.info(f"ChromaDB Collection Retrieved: {collection.name}")
-except Exception as e:
-    logger.error(f"Error creating/getting ChromaDB collection: {e}")
-
-def extract_text_from_pdf(pdf_bytes):
-    """Extract text content from the PDF."""
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    return "\n".join(page.get_text("text") for page in doc)
-
-def generate_gemini_response(text):
-    """Generate AI response using Gemini-Pro."""
+IAM_TOKEN_URL = (
+    "http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/identity"
+    f"?audience={CHROMA_DB_URL}"
+)
+IAM_TOKEN_LIFETIME = 3500  # identity tokens expire after one hour
+IAM_TOKEN_TIMEOUT = 5  # seconds; the fetch holds a lock every request waits on
+IAM_TOKEN_RETRY_BACKOFF = 30  # seconds to keep serving a cached token after a failed refresh
+_iam_token = None
+_iam_token_exp = 0.0
+_iam_token_retry_at = 0.0
+_iam_token_lock = threading.Lock()
+
+def get_iam_token():
+    """Return the cached IAM identity token, refreshing it shortly before expiry."""
+    global _iam_token, _iam_token_exp, _iam_token_retry_at
+    with _iam_token_lock:
+        now = time.time()
+        if _iam_token is not None and (now < _iam_token_exp - 60 or now < _iam_token_retry_at):
+            return _iam_token
+        try:
+            response = SESSION.get(IAM_TOKEN_URL, headers={"Metadata-Flavor": "Google"}, timeout=IAM_TOKEN_TIMEOUT)
+            response.raise_for_status()
+            # Only replace the cached token once a fetch has succeeded
+            _iam_token = response.text.strip()
+            _iam_token_exp = now + IAM_TOKEN_LIFETIME
+            logger.info("IAM Token Fetched.")
+        except Exception as e:
+            logger.error(f"Error fetching IAM token: {e}")
+            # Don't make every request wait on the metadata server while it is failing
+            _iam_token_retry_at = now + IAM_TOKEN_RETRY_BACKOFF
+        return _iam_token
+
+# ChromaDB client and collection, created on first use (not at import, to keep
+# cold starts fast) and rebuilt whenever the IAM token rotates
+_chroma_client = None
+_collection = None
+_collection_token = None
+_collection_lock = threading.Lock()
+
+def is_cosine_collection(collection):
+    """Whether the collection was created with cosine distance (needed by the semantic cache)."""
+    return (collection.metadata or {}).get("hnsw:space") == "cosine"
+
+def close_chroma_client(client):
+    """Stop a replaced ChromaDB client's System and drop it from chromadb's shared registry."""
+    # chromadb keeps every HttpClient's System in a class-level dict keyed by a fresh
+    # uuid and never evicts it, so each token rotation would otherwise leak one
+    try:
+        client._system.stop()
+        SharedSystemClient._identifier_to_system.pop(client._identifier, None)
+    except Exception as e:
+        logger.error(f"Error closing previous ChromaDB client: {e}")
+
+def get_collection():
+    """Return the ChromaDB collection, reconnecting with a fresh token when needed."""
+    global _chroma_client, _collection, _collection_token
+    token = get_iam_token()
+    with _collection_lock:
+        if _collection is None or token != _collection_token:
+            chroma_client = chromadb.HttpClient(CHROMA_DB_URL, headers={"Authorization": f"Bearer {token}"})
+            _collection = chroma_client.get_or_create_collection(
+                "cast_highlight_reports", metadata={"hnsw:space": "cosine"}
+            )
+            if _chroma_client is not None:
+                close_chroma_client(_chroma_client)
+            _chroma_client = chroma_client
+            _collection_token = token
+            logger.info(f"ChromaDB Collection Retrieved: {_collection.name}")
+            if not is_cosine_collection(_collection):
+                logger.warning(
+                    f"Collection {_collection.name} doesn't use cosine distance; "
+                    "semantic cache disabled until it is recreated with hnsw:space=cosine"
+                )
+        return _collection
+
+class LRUCache:
+    """Small thread-safe LRU cache backed by an OrderedDict."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+# PDF content hash -> Gemini summary
+summary_cache = LRUCache(CACHE_MAX_ENTRIES)
+# Chunk text hash -> float32 embedding, for chunks repeated across reports
+embedding_cache = LRUCache(EMBEDDING_CACHE_MAX_ENTRIES)
+
+def get_cached_summary(key):
+    """Return a previously generated summary for a PDF content hash, if any."""
+    summary = summary_cache.get(key)
+    if summary is not None:
+        logger.info(f"Summary cache hit (memory) for {key}")
+        return summary
+
+    try:
+        result = get_collection().get(ids=[key], include=["metadatas"])
+        if result["ids"]:
+            summary = (result["metadatas"][0] or {}).get("summary")
+            if summary is not None:
+                logger.info(f"Summary cache hit (ChromaDB) for {key}")
+                summary_cache.put(key, summary)
+                return summary
+    except Exception as e:
+        logger.error(f"Error looking up cached summary in ChromaDB: {e}")
+    return None
+
+def find_similar_summary(embedding_vector):
+    """Return (summary, ts) of a fresh, near-duplicate report already in ChromaDB."""
+    try:
+        collection = get_collection()
+        # get_or_create_collection() keeps the space of an existing collection, and
+        # SEMANTIC_CACHE_THRESHOLD is meaningless for L2 distances
+        if not is_cosine_collection(collection):
+            return None
+
+        # Only entries with a summary carry a "ts", so this also skips failed runs
+        result = collection.query(
+            query_embeddings=[embedding_vector],
+            n_results=1,
+            where={"ts": {"$gt": time.time() - SEMANTIC_CACHE_TTL}},
+            include=["metadatas", "distances"]
+        )
+        if result["ids"][0] and result["distances"][0][0] < SEMANTIC_CACHE_THRESHOLD:
+            metadata = result["metadatas"][0][0]
+            logger.info(f"Semantic cache hit: {result['ids'][0][0]} (distance {result['distances'][0][0]:.4f})")
+            return metadata["summary"], metadata["ts"]
+    except Exception as e:
+        logger.error(f"Error querying semantic cache in ChromaDB: {e}")
+    return None
+
+_bucket = None
+_bucket_lock = threading.Lock()
+
+def get_bucket():
+    """Return the report bucket, warning once if it isn't in REGION_ID."""
+    global _bucket
+    with _bucket_lock:
+        if _bucket is None:
+            bucket = storage_client.bucket(BUCKET_NAME)
+            try:
+                bucket.reload()
+                if bucket.location.lower() != REGION_ID.lower():
+                    logger.warning(
+                        f"Bucket {BUCKET_NAME} is in {bucket.location}, not {REGION_ID}; "
+                        "every download crosses regions"
+                    )
+            except Exception as e:
+                logger.error(f"Error checking bucket location: {e}")
+            _bucket = bucket
+        return _bucket
+
+@contextlib.contextmanager
+def download_pdf(file_name):
+    """Download a PDF from GCS to a temporary file and yield its path.
+
+    Raises FileNotFoundError if the object doesn't exist.
+    """
+    blob = get_bucket().blob(file_name)
+    # Leave chunk_size unset: a single streaming GET keeps the library's MD5 check,
+    # which chunked downloads skip
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as tmp:
+        try:
+            blob.download_to_file(tmp, raw_download=True)
+        except exceptions.NotFound as e:
+            raise FileNotFoundError(f"gs://{BUCKET_NAME}/{file_name}") from e
+        tmp.flush()
+        yield tmp.name
+
+def hash_file(path, block_size=1024 * 1024):
+    """SHA-256 of a file, read in blocks rather than all at once."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def iter_pdf_pages(pdf_path, batch=PAGE_BATCH_SIZE):
+    """Yield the PDF's text in chunks of `batch` pages."""
+    # Opening by path lets MuPDF read pages on demand instead of holding the whole file;
+    # close explicitly so its native memory is freed as soon as extraction ends
+    with fitz.open(pdf_path, filetype="pdf") as doc:
+        # Write block text straight into one buffer instead of joining per-page lists
+        buf = io.StringIO()
+        pages = 0
+        for page in doc:
+            blocks = page.get_text("blocks", flags=TEXT_BLOCK_FLAGS)
+            texts = [block[4] for block in blocks if block[6] == 0]  # type 0 = text
+            if not any(text.strip() for text in texts):
+                continue
+            for text in texts:
+                buf.write(text)
+                buf.write("\n")
+            pages += 1
+            if pages >= batch:
+                yield buf.getvalue()
+                buf = io.StringIO()
+                pages = 0
+        if pages:
+            yield buf.getvalue()
+
+def generate_text(content, label):
+    """Run one Gemini prompt, retrying transient errors; return None if it still fails."""
     try:
-        model = genai.GenerativeModel(MODEL_NAME)
-        response = model.generate_content(f"Summarize this text:\n{text}")
-        return response.text
+        return GEMINI_MODEL.generate_content(content, request_options={"retry": GEMINI_RETRY}).text
     except Exception as e:
-        logger.error(f"Error generating Gemini response: {e}")
+        # Includes safety-blocked responses, whose .text raises ValueError
+        logger.error(f"Gemini call failed for {label}: {e}")
+        return None
+
+def summarize_window(text, cancelled, index):
+    """Summarize a single window of report text, unless the summary was cancelled."""
+    if cancelled.is_set():
+        return None
+    content = glm.Content(role="user", parts=[SUMMARY_PREAMBLE, glm.Part(text=text)])
+    return generate_text(content, f"summary window {index}")
+
+def combine_summaries(summaries, cancelled, index):
+    """Merge several partial summaries into one, unless the summary was cancelled."""
+    if cancelled.is_set():
+        return None
+    joined = "\n\n".join(summaries)
+    content = glm.Content(role="user", parts=[COMBINE_PREAMBLE, glm.Part(text=joined)])
+    combined = generate_text(content, f"combine group {index}")
+    # Keep the partial summaries rather than losing them if the combine call fails
+    return combined if combined is not None else joined
+
+def reduce_summaries(summaries, cancelled):
+    """Combine window summaries SUMMARY_FAN_IN at a time, skipping windows that failed."""
+    total = len(summaries)
+    summaries = [summary for summary in summaries if summary is not None]
+    if not cancelled.is_set() and len(summaries) < total:
+        logger.warning(f"{total - len(summaries)} of {total} summary windows failed; combining the rest")
+    while len(summaries) > 1 and not cancelled.is_set():
+        groups = [summaries[i:i + SUMMARY_FAN_IN] for i in range(0, len(summaries), SUMMARY_FAN_IN)]
+        summaries = list(summary_executor.map(
+            combine_summaries, groups, [cancelled] * len(groups), range(len(groups))
+        ))
+    if cancelled.is_set() or not summaries:
         return None
+    return summaries[0]
 
-def generate_embeddings(text):
-    """Generate embeddings using Gemini AI."""
+def generate_embeddings(texts):
+    """Generate embeddings for a batch of texts in one Gemini AI request."""
     try:
         response = genai.embed_content(
             model=EMBEDDING_MODEL_NAME,
-            content=text,
+            content=texts,
             task_type="RETRIEVAL_DOCUMENT"
         )
-        logger.info("Embedding Generated Successfully.")
+        logger.info(f"Embeddings Generated Successfully for {len(texts)} chunks.")
         return response["embedding"]
     except Exception as e:
         logger.error(f"Error generating embeddings: {e}")
         return None
 
-def store_embeddings_in_chroma(file_name, text):
-    """Store embeddings in ChromaDB and print stored vectors."""
-    logger.info(f"🔍 Storing Embeddings for: {file_name}")
+def embed_chunks(chunks, batch=EMBED_BATCH_SIZE):
+    """Embed chunks `batch` at a time, skipping cached ones; return None if any request fails."""
+    if not chunks:
+        return None
+    hashes = [hashlib.blake2b(chunk.encode(), digest_size=16).digest() for chunk in chunks]
+    embeddings = {h: embedding_cache.get(h) for h in hashes}
+    # Only send chunks we haven't embedded before, once each
+    misses = {h: chunk for h, chunk in zip(hashes, chunks) if embeddings[h] is None}
+    if len(misses) < len(chunks):
+        logger.info(f"Embedding cache hit for {len(chunks) - len(misses)} of {len(chunks)} chunks")
+    miss_hashes, miss_chunks = list(misses), list(misses.values())
+    for i in range(0, len(miss_chunks), batch):
+        batch_embeddings = generate_embeddings(miss_chunks[i:i + batch])
+        if batch_embeddings is None:
+            return None
+        for h, embedding in zip(miss_hashes[i:i + batch], batch_embeddings):
+            embeddings[h] = np.asarray(embedding, dtype=np.float32)
+            embedding_cache.put(h, embeddings[h])
+    return [embeddings[h] for h in hashes]
 
-    embedding_vector = generate_embeddings(text)
-    if embedding_vector is None:
-        logger.error("Skipping storage due to embedding failure.")
-        return
-    
-    logger.info(f"Embedding vectors:{embedding_vector}")  
+def stream_report(chunks, cancelled):
+    """Embed page batches and start their summary windows as the batches are extracted.
 
+    Returns (previews, chunk_embeddings, window_futures); chunk_embeddings is None if
+    any embedding fails. Only the current page batch plus at most SUMMARY_WORKERS
+    queued windows of text are held at a time.
+    """
+    previews, chunk_embeddings, window_futures = [], [], []
+    pending = set()
+    total_chars = 0
     try:
-        logger.debug(f"Embedding Vector Length: {len(embedding_vector)}")
+        for chunk in chunks:
+            for i in range(0, len(chunk), SUMMARY_WINDOW_CHARS):
+                # Backpressure: wait for a window to finish rather than queueing more text
+                while len(pending) >= SUMMARY_WORKERS:
+                    _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                future = summary_executor.submit(
+                    summarize_window, chunk[i:i + SUMMARY_WINDOW_CHARS], cancelled, len(window_futures)
+                )
+                window_futures.append(future)
+                pending.add(future)
+            # Embed on this thread while the summary windows run in the pool
+            if chunk_embeddings is not None:
+                embeddings = embed_chunks([chunk])
+                chunk_embeddings = chunk_embeddings + embeddings if embeddings is not None else None
+            previews.append(chunk[:CONTENT_PREVIEW_CHARS])
+            total_chars += len(chunk)
+    except BaseException:
+        # Don't leave queued windows spending Gemini calls for a failed request
+        cancelled.set()
+        raise
+    logger.info(f"Extracted Text Length: {total_chars} characters in {len(previews)} chunks")
+    return previews, chunk_embeddings if previews else None, window_futures
 
-        # Store embedding in ChromaDB
-        collection.add(
-            ids=[file_name],
-            embeddings=[embedding_vector],
-            metadatas=[{"file_name": file_name, "content": text[:500]}]
-        )
-        logger.info(f"Successfully stored {file_name} in ChromaDB")
+def mean_vector(vectors):
+    """Element-wise mean of equal-length vectors."""
+    return np.mean(np.asarray(vectors, dtype=np.float32), axis=0)
 
-        # Print the stored embedding vector
-        logger.info(f"\n **Stored Embedding Vector for {file_name}:**")
+def quantize_embedding(vector):
+    """Normalize a vector and round it to int8 levels (-127..127)."""
+    # Cosine distance ignores the 1/127 scale, so ChromaDB gets the ints as-is
+    v = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(v)
+    if norm > 0:
+        v = v / norm
+    return np.round(v * 127).astype(np.int8).tolist()
 
-    except Exception as e:
-        logger.error(f"Error storing in ChromaDB: {e}")
+def encode_embedding(vector, quantize):
+    """Prepare a vector for ChromaDB: int8 levels for cosine collections, float32 otherwise."""
+    # The ±127 scale would distort L2 distances against existing unit-norm float vectors
+    if quantize:
+        return quantize_embedding(vector)
+    return np.asarray(vector, dtype=np.float32).tolist()
+
+def store_embeddings_in_chroma(key, file_name, previews, chunk_embeddings, embedding_vector, summary, ts):
+    """Store the report and its chunk embeddings in ChromaDB, keyed by PDF content hash."""
+    logger.info(f"🔍 Storing Embeddings for: {file_name}")
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Embedding Vector Length: %d, first values: %s", len(embedding_vector), embedding_vector[:4])
+
+    metadata = {"file_name": file_name, "content": previews[0], "type": "document"}
+    if summary is not None:
+        metadata["summary"] = summary
+        metadata["ts"] = ts
+
+    # Upsert so a later run can fill in a summary that previously failed;
+    # the document and all of its chunks go in a single request
+    get_collection().upsert(
+        ids=[key] + [f"{key}#p{i}" for i in range(len(previews))],
+        embeddings=[embedding_vector] + list(chunk_embeddings),
+        metadatas=[metadata] + [
+            {"file_name": file_name, "content": preview, "type": "chunk", "chunk": i}
+            for i, preview in enumerate(previews)
+        ]
+    )
+    logger.info(f"Successfully stored {file_name} in ChromaDB")
+
+    # Print the stored embedding vector
+    logger.info(f"\n **Stored Embedding Vector for {file_name}:**")
+
+# Background ChromaDB writes, so /process doesn't wait on the cross-region round-trip;
+# bounded so a ChromaDB outage can't grow memory without limit
+chroma_write_queue = queue.Queue(maxsize=CHROMA_WRITE_QUEUE_SIZE)
+_chroma_writer = None
+_chroma_writer_lock = threading.Lock()
+
+def chroma_write_worker():
+    """Drain the write queue, retrying failed ChromaDB writes with exponential backoff."""
+    while True:
+        args = chroma_write_queue.get()
+        for attempt in range(CHROMA_WRITE_RETRIES):
+            try:
+                store_embeddings_in_chroma(*args)
+                break
+            except Exception as e:
+                logger.error(f"Error storing in ChromaDB (attempt {attempt + 1}/{CHROMA_WRITE_RETRIES}): {e}")
+                if attempt + 1 < CHROMA_WRITE_RETRIES:
+                    time.sleep(2 ** attempt)
+        chroma_write_queue.task_done()
+
+def enqueue_chroma_write(key, file_name, *args):
+    """Queue a ChromaDB write for the background writer thread."""
+    global _chroma_writer
+    with _chroma_writer_lock:
+        # Started on first use: a thread started at import wouldn't survive gunicorn's preload fork
+        if _chroma_writer is None or not _chroma_writer.is_alive():
+            _chroma_writer = threading.Thread(target=chroma_write_worker, daemon=True)
+            _chroma_writer.start()
+    try:
+        chroma_write_queue.put_nowait((key, file_name, *args))
+    except queue.Full:
+        logger.error(f"ChromaDB write queue full; dropping write for {file_name}")
+
+def drain_chroma_writes(timeout=CHROMA_DRAIN_TIMEOUT):
+    """Wait up to timeout seconds for queued ChromaDB writes; called on worker shutdown."""
+    deadline = time.monotonic() + timeout
+    with chroma_write_queue.all_tasks_done:
+        while chroma_write_queue.unfinished_tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            chroma_write_queue.all_tasks_done.wait(remaining)
+        abandoned = chroma_write_queue.unfinished_tasks
+    if abandoned:
+        logger.error(f"Shutting down with {abandoned} ChromaDB write(s) abandoned")
+    else:
+        logger.info("ChromaDB write queue drained")
 
 
 # Flask App
+class OrjsonProvider(DefaultJSONProvider):
+    """Serialize Flask JSON responses with orjson instead of the stdlib json module."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 @app.route("/process", methods=["POST"])
 def process_file():
     """Process PDF file from GCS, generate summary & store embeddings."""
     logger.info("\n Processing File...")
+    payload = request.get_json(silent=True)
+    if payload is None:
+        payload = {}
+    if not isinstance(payload, dict):
+        return jsonify({"error": "request body must be a JSON object"}), 400
+    file_name = payload.get("file_name", FILE_NAME)
+    if not isinstance(file_name, str) or not file_name:
+        return jsonify({"error": "file_name must be a non-empty string"}), 400
+
     try:
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(FILE_NAME)
-        pdf_bytes = blob.download_as_bytes()
+        # Stream page batches into embedding and summary calls as they are extracted,
+        # so at most one batch of page text is held; the temporary file goes at the end
+        previews = None
+        with download_pdf(file_name) as pdf_path:
+            key = hash_file(pdf_path)
+            gemini_response = get_cached_summary(key)
+            if gemini_response is None:
+                summary_cancelled = threading.Event()
+                previews, chunk_embeddings, window_futures = stream_report(
+                    iter_pdf_pages(pdf_path), summary_cancelled
+                )
 
-        extracted_text = extract_text_from_pdf(pdf_bytes)
-        logger.info(f"Extracted Text Length: {len(extracted_text)} characters")
+        if previews is not None:
+            embedding_vector = None
+            if chunk_embeddings is not None:
+                try:
+                    quantize = is_cosine_collection(get_collection())
+                except Exception as e:
+                    # Float vectors are safe in either space, so fall back to those
+                    logger.error(f"Error checking ChromaDB collection space: {e}")
+                    quantize = False
+                embedding_vector = encode_embedding(mean_vector(chunk_embeddings), quantize)
+                chunk_embeddings = [encode_embedding(embedding, quantize) for embedding in chunk_embeddings]
+            similar = find_similar_summary(embedding_vector) if embedding_vector is not None else None
+            if similar is not None:
+                # Stop the in-flight summary from spending further Gemini calls, and
+                # keep the original timestamp so near-duplicates can't extend the TTL
+                summary_cancelled.set()
+                for future in window_futures:
+                    future.cancel()
+                gemini_response, ts = similar
+            else:
+                summaries = [future.result() for future in window_futures]
+                gemini_response, ts = reduce_summaries(summaries, summary_cancelled), time.time()
 
-        gemini_response = generate_gemini_response(extracted_text)
-        store_embeddings_in_chroma(FILE_NAME, extracted_text)
+            if gemini_response is not None:
+                summary_cache.put(key, gemini_response)
+            if not previews:
+                logger.warning(f"No extractable text in {file_name}; nothing to summarize or store.")
+            elif embedding_vector is None:
+                logger.error("Skipping storage due to embedding failure.")
+            else:
+                # The response doesn't depend on the write, so don't wait for it
+                enqueue_chroma_write(
+                    key, file_name, previews, chunk_embeddings, embedding_vector, gemini_response, ts
+                )
 
-        return jsonify({"message": "Processing complete", "file": FILE_NAME, "gemini_summary": gemini_response})
+        return jsonify({"message": "Processing complete", "file": file_name, "gemini_summary": gemini_response})
+    except FileNotFoundError as e:
+        logger.warning(f"File not found: {e}")
+        return jsonify({"error": f"File not found: {file_name}"}), 404
     except Exception as e:
         logger.error(f"Error processing file: {e}")
         return jsonify({"error": str(e)}), 500
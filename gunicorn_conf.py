@@ -0,0 +1,16 @@
+import os
+
+# Cloud Run injects PORT; one worker with many threads suits the I/O-bound /process handler
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = 1
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+# Import app.py once so the Gemini model, ChromaDB client and token cache are set up before serving
+preload_app = True
+# Cloud Run enforces the request timeout; don't let gunicorn kill long summaries first
+timeout = 0
+
+def worker_exit(server, worker):
+    # The ChromaDB writer is a daemon thread; flush its queue before the worker exits
+    from app import drain_chroma_writes
+    drain_chroma_writes()